@@ -1,44 +1,105 @@
 """Download metadata from the Deutsche Digitale Bibliothek using the OAI-PMH protocol."""
 
 import concurrent.futures
+import hashlib
+import io
+import logging
+import logging.handlers
 import os
+import random
+import threading
 import time
-import xml.etree.ElementTree as ET
+from collections.abc import Generator
 
-import requests
+import httpx
+import orjson
+from lxml import etree
 
 OAI_URL = "https://oai.deutsche-digitale-bibliothek.de/oai"
 METADATA_PREFIX = "ddb"
 SAVE_DIR = ""
 MAX_RETRIES = 10
+MAX_BACKOFF = 60
+LOG_LEVEL = "INFO"
 THREADS = 10
+STATE_FILE = ".harvest_state.records.jsonl"
+CHECKPOINT_INTERVAL = 64
+NS = "{http://www.openarchives.org/OAI/2.0/}"
+NAMESPACES = {"oai": "http://www.openarchives.org/OAI/2.0/"}
+
+SET_SPEC = etree.XPath(
+    "oai:ListSets/oai:set/oai:setSpec/text()",
+    namespaces=NAMESPACES,
+    smart_strings=False,
+)
+LIST_RECORDS = etree.XPath("oai:ListRecords", namespaces=NAMESPACES)
+RESUMPTION_TOKEN = etree.XPath(
+    "oai:ListRecords/oai:resumptionToken", namespaces=NAMESPACES
+)
+OAI_ERROR = etree.XPath("oai:error", namespaces=NAMESPACES)
+IDENTIFIER = etree.XPath(
+    "oai:header/oai:identifier/text()", namespaces=NAMESPACES, smart_strings=False
+)
+
+FILE_NAME_TRANSLATION = str.maketrans(
+    {character: f"%{ord(character):02X}" for character in '%:/\\<>*?|"'}
+)
+
+created_dirs = set()
+state_lock = threading.Lock()
+state_writes = 0
+
+logger = logging.getLogger(__name__)
+
+
+def create_client() -> httpx.Client:
+    """
+    Create the HTTP/2 client shared by all requests to the OAI-PMH endpoint.
 
+    Returns:
+        httpx.Client: A client multiplexing requests over pooled connections.
 
-def list_sets() -> requests.Response:
+    """
+
+    return httpx.Client(
+        http2=True,
+        limits=httpx.Limits(
+            max_keepalive_connections=THREADS, max_connections=2 * THREADS
+        ),
+        timeout=httpx.Timeout(80.0, connect=20.0),
+        follow_redirects=True,
+        headers={"User-Agent": "ddb_harvester", "Accept-Encoding": "gzip, deflate"},
+    )
+
+
+def list_sets(client: httpx.Client) -> httpx.Response:
     """
     List all sets available in the DDB OAI-PMH endpoint.
 
+    Args:
+        client (httpx.Client): The HTTP client.
+
     Returns:
-        requests.Response: The response object from the OAI-PMH endpoint.
+        httpx.Response: The response object from the OAI-PMH endpoint.
 
     """
 
     params = {"verb": "ListSets"}
-    result = requests.get(OAI_URL, params=params, timeout=None)
+    result = client.get(OAI_URL, params=params, timeout=None)
 
     if result.status_code != 200:
-        print(f"Error {result.status_code}: {result.text}")
+        logger.error("Error %s: %s", result.status_code, result.text)
         return None
 
     return result
 
 
-def parse_sets(xml_data: str) -> list:
+def parse_sets(xml_data: bytes) -> list:
     """
     Parse the XML data to extract the set specifications (set-ids).
 
     Args:
-        xml_data (str): The XML response from the ListSets call on the OAI-PMH endpoint.
+        xml_data (bytes): The XML response from the ListSets call on the OAI-PMH endpoint.
 
     Returns:
         list: A list of set ids.
@@ -46,223 +107,410 @@ def parse_sets(xml_data: str) -> list:
     """
 
     sets = []
-    root = ET.fromstring(xml_data)
-
-    for set_element in root.findall(".//{http://www.openarchives.org/OAI/2.0/}set"):
-        set_spec = set_element.find(
-            "{http://www.openarchives.org/OAI/2.0/}setSpec"
-        ).text
+    root = etree.fromstring(xml_data)
 
+    for set_spec in SET_SPEC(root):
         if ":" not in set_spec:
             sets.append(set_spec)
 
     return sets
 
 
-def make_request(
-    params: dict, session: requests.Session, retries=0
-) -> requests.Response:
+def make_request(params: dict, client: httpx.Client) -> httpx.Response:
     """
     Make a request to the OAI-PMH endpoint.
 
+    Transport errors (failed connections, timeouts, broken streams), bodies that fail to
+    decompress and 5xx/429 responses are retried up to MAX_RETRIES times with a jittered
+    exponential backoff capped at MAX_BACKOFF seconds. Other HTTP errors are raised
+    immediately.
+
     Args:
         params (dict): The parameters to be passed to the OAI-PMH endpoint.
-        session (requests.Session): The requests session object.
-        retries (int): The number of retries attempted.
+        client (httpx.Client): The HTTP client.
 
     Returns:
-        requests.Response: The response object from the OAI-PMH endpoint.
+        httpx.Response: The response object from the OAI-PMH endpoint.
 
     """
 
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt:
+            time.sleep(min(MAX_BACKOFF, 2 ** (attempt - 1)) + random.random())
+
+        try:
+            response = client.get(OAI_URL, params=params)
+            response.raise_for_status()
+            return response
+
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code < 500 and e.response.status_code != 429:
+                raise
+
+            error = e
+
+        except (httpx.TransportError, httpx.DecodingError) as e:
+            error = e
+
+    raise error
+
+
+def load_state() -> dict:
+    """
+    Read the harvest state log and get the last checkpoint of every set. A torn line left by
+    a crash at the end of the log is cut off, so new checkpoints start on a fresh line.
+
+    Returns:
+        dict: The last checkpoint (set, resumption token and record count) per set id.
+            A token of None marks a completed set.
+
+    """
+
+    state_path = os.path.join(SAVE_DIR, STATE_FILE)
+
     try:
-        response = session.get(OAI_URL, params=params, timeout=(20, 80))
-        response.raise_for_status()
-        return response
+        with open(state_path, "rb") as f:
+            data = f.read()
 
-    except requests.exceptions.RequestException as e:
-        if retries < MAX_RETRIES:
-            wait_time = 2**retries
-            time.sleep(wait_time)
+    except FileNotFoundError:
+        return {}
 
-            return make_request(params, session, retries + 1)
+    if not data.endswith(b"\n"):
+        os.truncate(state_path, data.rfind(b"\n") + 1)
 
-        else:
-            raise e
+    lines = data.split(b"\n")[:-1]
+
+    state = {}
+
+    for line in lines:
+        try:
+            checkpoint = orjson.loads(line)
 
+        except orjson.JSONDecodeError:
+            continue
 
-def list_identifiers(set_spec: str, session: requests.Session) -> list:
+        state[checkpoint["set"]] = checkpoint
+
+    return state
+
+
+def save_state(set_spec: str, resumption_token: str | None, harvested_records: int):
     """
-    List all identifiers for a given set. Collects all identifiers across paginated results.
+    Append a checkpoint for a set to the harvest state log. The log is synced to disk every
+    CHECKPOINT_INTERVAL checkpoints and whenever a set is completed.
 
     Args:
         set_spec (str): The set specification (set-id).
-        session (requests.Session): The requests session object.
+        resumption_token (str | None): The token of the next page, None once the set is completed.
+        harvested_records (int): The number of records harvested for the set so far.
+
+    """
+
+    global state_writes
+
+    line = orjson.dumps(
+        {"set": set_spec, "token": resumption_token, "count": harvested_records}
+    )
+
+    with state_lock:
+        fd = os.open(
+            os.path.join(SAVE_DIR, STATE_FILE),
+            os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+            0o644,
+        )
+
+        try:
+            write_all(fd, line + b"\n")
+            state_writes += 1
+
+            if resumption_token is None or state_writes % CHECKPOINT_INTERVAL == 0:
+                os.fsync(fd)
+
+        finally:
+            os.close(fd)
 
-    Returns:
-        list: A list of found identifiers.
 
+def list_records(
+    set_spec: str, client: httpx.Client, checkpoint: dict | None = None
+) -> Generator[tuple[str, bytes], None, None]:
     """
+    List all records for a given set. Records are yielded page by page across paginated results.
 
-    identifiers = []
-    expected_identifiers_in_set = 0
-    resumption_token = None
+    A checkpoint is saved to the harvest state log after every finished page, so an
+    interrupted harvest continues from the last checkpointed page. If the server rejects
+    the checkpointed resumption token, the set is harvested again from the start. Other
+    OAI errors are logged and leave the last checkpoint in place; the set is only marked
+    as completed once a ListRecords page ends without a resumption token.
 
-    params = {
-        "verb": "ListIdentifiers",
-        "metadataPrefix": METADATA_PREFIX,
-        "set": set_spec,
-    }
+    Args:
+        set_spec (str): The set specification (set-id).
+        client (httpx.Client): The HTTP client.
+        checkpoint (dict | None): The checkpoint of an interrupted harvest of the set.
+
+    Yields:
+        tuple: The identifier and the UTF-8 encoded XML of a record.
+
+    """
+
+    harvested_records = checkpoint["count"] if checkpoint else 0
+    resumption_token = checkpoint["token"] if checkpoint else None
+    expected_records_in_set = 0
+
+    if resumption_token:
+        logger.info("Resuming set %s after %d records.", set_spec, harvested_records)
+
+    restarted = False
 
     while True:
         if resumption_token:
-            params = {"verb": "ListIdentifiers", "resumptionToken": resumption_token}
+            params = {"verb": "ListRecords", "resumptionToken": resumption_token}
+
+        else:
+            params = {
+                "verb": "ListRecords",
+                "metadataPrefix": METADATA_PREFIX,
+                "set": set_spec,
+            }
 
-        response = make_request(params, session)
+        response = make_request(params, client)
 
         if response.status_code == 200:
-            identifiers.extend(parse_identifiers(response.text))
-
-            if expected_identifiers_in_set == 0:
-                try:
-                    expected_identifiers_in_set = int(
-                        ET.fromstring(response.text)
-                        .find(
-                            ".//{http://www.openarchives.org/OAI/2.0/}resumptionToken"
-                        )
-                        .attrib["completeListSize"]
-                    )
+            root, page_records = yield from parse_records_list(response.content)
+            errors = OAI_ERROR(root)
 
-                except AttributeError:
-                    print("No resumption token found.")
+            if errors:
+                error_code = errors[0].get("code")
 
-                    expected_identifiers_in_set = len(identifiers)
+                if error_code == "badResumptionToken" and not restarted:
+                    logger.warning(
+                        "Resumption token for set %s was rejected, restarting the set.",
+                        set_spec,
+                    )
+                    restarted = True
+                    harvested_records = 0
+                    expected_records_in_set = 0
+                    resumption_token = None
+                    continue
+
+                if error_code == "noRecordsMatch" and not resumption_token:
+                    break
+
+                logger.error(
+                    "OAI error %s for set %s: %s", error_code, set_spec, errors[0].text
+                )
+                return
+
+            if not LIST_RECORDS(root):
+                logger.error("Unexpected response for set %s without records.", set_spec)
+                return
+
+            harvested_records += page_records
+            resumption_tokens = RESUMPTION_TOKEN(root)
+            resumption_token_element = resumption_tokens[0] if resumption_tokens else None
+
+            if expected_records_in_set == 0:
+                if resumption_token_element is not None:
+                    expected_records_in_set = int(
+                        resumption_token_element.get("completeListSize")
+                    )
 
-            print(
-                f"Identifiers found: {len(identifiers)}/{expected_identifiers_in_set}"
-            )
+                else:
+                    logger.info("No resumption token found for set %s.", set_spec)
 
-            root = ET.fromstring(response.text)
-            resumption_token = root.findtext(
-                ".//{http://www.openarchives.org/OAI/2.0/}resumptionToken"
+                    expected_records_in_set = harvested_records
+
+            logger.info(
+                "Records found for set %s: %d/%d",
+                set_spec,
+                harvested_records,
+                expected_records_in_set,
             )
 
-            if not resumption_token:
+            if resumption_token_element is None or not resumption_token_element.text:
+                save_state(set_spec, None, harvested_records)
                 break
 
+            resumption_token = resumption_token_element.text
+            save_state(set_spec, resumption_token, harvested_records)
+
         else:
             break
 
-    if len(identifiers) != expected_identifiers_in_set:
-        print("-" * 60)
-        print(
-            f"Error: Expected {expected_identifiers_in_set} identifiers, found {len(identifiers)}."
+    if harvested_records != expected_records_in_set:
+        logger.error(
+            "Expected %d records for set %s, found %d.",
+            expected_records_in_set,
+            set_spec,
+            harvested_records,
         )
-        print("-" * 60)
 
-    return identifiers
 
-
-def parse_identifiers(xml_data: str) -> list:
+def parse_records_list(xml_data: bytes) -> Generator[tuple[str, bytes], None, tuple]:
     """
-    Parse the XML data to extract the identifiers.
+    Parse the XML data to extract the records. Each record is cleared once it has been serialized.
 
     Args:
-        xml_data (str): The XML response from the ListIdentifiers call on the OAI-PMH endpoint.
+        xml_data (bytes): The XML response from the ListRecords call on the OAI-PMH endpoint.
+
+    Yields:
+        tuple: The identifier and the UTF-8 encoded XML of a record.
 
     Returns:
-        list: A list of identifiers.
+        tuple: The root element of the response and the number of records on the page.
 
     """
 
-    identifiers = []
-    root = ET.fromstring(xml_data)
+    records = 0
+    context = etree.iterparse(
+        io.BytesIO(xml_data), tag=f"{NS}record", huge_tree=True
+    )
+
+    for _, record in context:
+        identifier = IDENTIFIER(record)[0]
+        yield identifier, etree.tostring(record, encoding="utf-8", with_tail=False)
+        records += 1
 
-    for identifier in root.findall(
-        ".//{http://www.openarchives.org/OAI/2.0/}identifier"
-    ):
-        identifiers.append(identifier.text)
+        record.clear()
+        while record.getprevious() is not None:
+            del record.getparent()[0]
 
-    return identifiers
+    return context.root, records
 
 
-def get_record_information(
-    identifier: str, session: requests.Session
-) -> requests.Response:
+def record_location(identifier: str) -> tuple[str, str]:
     """
-    Get the record information for a given identifier.
+    Get the shard directory and file name a record is saved to. Records are spread over 256
+    shard directories named after a one byte hash of the identifier. Characters that are not
+    allowed in file names (or would create subdirectories) are percent-encoded, as is '%'
+    itself, so distinct identifiers never share a file name.
 
     Args:
         identifier (str): The identifier of the record.
-        session (requests.Session): The requests session object.
 
     Returns:
-        requests.Response: The metadata for a record as xml response.
+        tuple: The shard directory and the file name of the record.
 
     """
 
-    params = {
-        "verb": "GetRecord",
-        "metadataPrefix": METADATA_PREFIX,
-        "identifier": identifier,
-    }
-
-    retries = 0
-
-    while retries < MAX_RETRIES:
-        response = make_request(params, session)
-        if (
-            response.status_code != 200
-            or '<error code="cannotDisseminateFormat">' in response.text
-            or '<error code="idDoesNotExist">' in response.text
-        ):
-            retries += 1
-            time.sleep(5 * retries)
-            print(f"Error: {response.text}")
-            print(f"Retrying in {5 * retries} seconds ...")
-        else:
-            break
+    shard = hashlib.blake2b(identifier.encode(), digest_size=1).hexdigest()
 
-    return response
+    return shard, identifier.translate(FILE_NAME_TRANSLATION) + ".xml"
 
 
-def process_record(identifier: str, session, set_spec: str):
+def list_saved_records(dataset_id: str) -> set[tuple[str, str]]:
     """
-    Process a single identifier and save the metadata to a file.
+    List the records already saved for a set.
 
     Args:
-        identifier (str): The identifier of the record.
-        session: The requests session object.
-        set_spec (str): The set specification (set-id).
+        dataset_id (str): The set specification (set-id).
+
+    Returns:
+        set: The shard directories and file names of the saved records.
 
     """
 
-    print(f"Processing record: {identifier}")
+    saved_records = set()
+    directory_path = os.path.join(SAVE_DIR, dataset_id)
+
+    if not os.path.isdir(directory_path):
+        return saved_records
+
+    for shard in os.scandir(directory_path):
+        if shard.is_dir():
+            saved_records.update(
+                (shard.name, file_name) for file_name in os.listdir(shard.path)
+            )
+
+    return saved_records
+
+
+def write_all(fd: int, data: bytes):
+    """
+    Write data to a file descriptor, repeating os.write until nothing is left after partial writes.
+
+    Args:
+        fd (int): The file descriptor to write to.
+        data (bytes): The data to write.
+
+    """
 
-    result = get_record_information(identifier, session)
+    view = memoryview(data)
 
-    if result.status_code == 200:
-        save_record_data(result.text, identifier, set_spec)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
 
 
-def save_record_data(record_xml: str, identifier: str, dataset_id: str):
+def save_record_data(record_xml: bytes, identifier: str, dataset_id: str):
     """
     Save record as xml
 
     Args:
-        record_xml (str): The record data as XML str.
+        record_xml (bytes): The record data as UTF-8 encoded XML.
         identifier (str): The identifier of the record.
         dataset_id (str): The set specification (set-id).
 
     """
 
-    directory_path = os.path.join(SAVE_DIR, dataset_id)
-    os.makedirs(directory_path, exist_ok=True)
+    shard, file_name = record_location(identifier)
+    directory_path = os.path.join(SAVE_DIR, dataset_id, shard)
+
+    if (dataset_id, shard) not in created_dirs:
+        os.makedirs(directory_path, exist_ok=True)
+        created_dirs.add((dataset_id, shard))
+
+    file_path = os.path.join(directory_path, file_name)
+
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    try:
+        write_all(fd, record_xml)
+
+    finally:
+        os.close(fd)
+
+
+def harvest_set(set_spec: str, client: httpx.Client, checkpoint: dict | None = None):
+    """
+    Harvest all records of a set and save each of them to a file. Records that are already
+    saved are skipped.
+
+    Args:
+        set_spec (str): The set specification (set-id).
+        client (httpx.Client): The HTTP client.
+        checkpoint (dict | None): The checkpoint of an interrupted harvest of the set.
 
-    file_path = os.path.join(directory_path, identifier + ".xml")
+    """
+
+    logger.info("Processing set: %s", set_spec)
+
+    saved_records = list_saved_records(set_spec)
+    harvested_records = 0
+    skipped_records = 0
+
+    for identifier, record_xml in list_records(set_spec, client, checkpoint):
+        location = record_location(identifier)
 
-    with open(file_path, "w", encoding="utf-8") as f:
-        f.write(record_xml)
+        if location in saved_records:
+            logger.debug("Skipping already saved record: %s", identifier)
+            skipped_records += 1
+            continue
+
+        logger.debug("Saving record: %s", identifier)
+        save_record_data(record_xml, identifier, set_spec)
+        saved_records.add(location)
+        harvested_records += 1
+
+    if harvested_records or skipped_records:
+        logger.info(
+            "Saved %d records for set %s, skipped %d already saved records",
+            harvested_records,
+            set_spec,
+            skipped_records,
+        )
+
+    else:
+        logger.info("No records found for set %s", set_spec)
 
 
 def harvest_ddb_data():
@@ -271,36 +519,53 @@ def harvest_ddb_data():
     
     """
 
-    response = list_sets()
+    os.makedirs(SAVE_DIR or os.curdir, exist_ok=True)
+    state = load_state()
+
+    with create_client() as client:
+        response = list_sets(client)
 
-    if response:
-        sets = parse_sets(response.text)
-        print(f"Found {len(sets)} unique sets.")
+        if response:
+            sets = parse_sets(response.content)
+            logger.info("Found %d unique sets.", len(sets))
 
-        session = requests.Session()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=THREADS) as executor:
+                inflight = set()
 
-        for set_spec in sets:
-            print(f"Processing set: {set_spec}")
+                for set_spec in sets:
+                    checkpoint = state.get(set_spec)
 
-            identifiers = list_identifiers(set_spec, session)
+                    if checkpoint and checkpoint["token"] is None:
+                        logger.info("Skipping completed set: %s", set_spec)
+                        continue
 
-            if identifiers:
-                print(f"Found {len(identifiers)} identifiers for set {set_spec}")
+                    if len(inflight) >= 2 * THREADS:
+                        done, inflight = concurrent.futures.wait(
+                            inflight, return_when=concurrent.futures.FIRST_COMPLETED
+                        )
 
-                with concurrent.futures.ThreadPoolExecutor(
-                    max_workers=THREADS
-                ) as executor:
-                    futures = [
-                        executor.submit(process_record, identifier, session, set_spec)
-                        for identifier in identifiers
-                    ]
+                        for future in done:
+                            future.result()
 
-                    for future in concurrent.futures.as_completed(futures):
-                        future.result()
+                    inflight.add(
+                        executor.submit(harvest_set, set_spec, client, checkpoint)
+                    )
 
-            else:
-                print(f"No identifiers found for set {set_spec}")
+                for future in concurrent.futures.as_completed(inflight):
+                    future.result()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=LOG_LEVEL,
+        handlers=[
+            logging.handlers.MemoryHandler(
+                capacity=1024,
+                flushLevel=logging.INFO,
+                target=logging.StreamHandler(),
+            )
+        ],
+    )
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
     harvest_ddb_data()
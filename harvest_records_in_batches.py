@@ -1,10 +1,17 @@
 """Harvest records from the Deutsche Digitale Bibliothek OAI-PMH endpoint using GetRecords."""
 
+import concurrent.futures
+import io
+import logging
+import logging.handlers
 import os
+import random
+import threading
 import time
-import xml.etree.ElementTree as ET
+from collections.abc import Generator, Iterable
 
-import requests
+import httpx
+import orjson
 from lxml import etree
 
 
@@ -12,33 +19,86 @@ OAI_URL = "https://oai.deutsche-digitale-bibliothek.de/oai"
 METADATA_PREFIX = "ddb"
 SAVE_DIR = ""
 MAX_RETRIES = 10
+MAX_BACKOFF = 60
+LOG_LEVEL = "INFO"
+THREADS = 10
+BATCH_SIZE = 1000
+STATE_FILE = ".harvest_state.batches.jsonl"
+CHECKPOINT_INTERVAL = 64
+NS = "{http://www.openarchives.org/OAI/2.0/}"
+NAMESPACES = {"oai": "http://www.openarchives.org/OAI/2.0/"}
+BATCH_HEADER = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    b'<records xmlns="http://www.openarchives.org/OAI/2.0/">\n'
+)
+BATCH_FOOTER = b"</records>\n"
+
+SET_SPEC = etree.XPath(
+    "oai:ListSets/oai:set/oai:setSpec/text()",
+    namespaces=NAMESPACES,
+    smart_strings=False,
+)
+LIST_RECORDS = etree.XPath("oai:ListRecords", namespaces=NAMESPACES)
+RESUMPTION_TOKEN = etree.XPath(
+    "oai:ListRecords/oai:resumptionToken", namespaces=NAMESPACES
+)
+OAI_ERROR = etree.XPath("oai:error", namespaces=NAMESPACES)
+
+created_dirs = set()
+state_lock = threading.Lock()
+state_writes = 0
+
+logger = logging.getLogger(__name__)
+
+
+def create_client() -> httpx.Client:
+    """
+    Create the HTTP/2 client shared by all requests to the OAI-PMH endpoint.
+
+    Returns:
+        httpx.Client: A client multiplexing requests over pooled connections.
+
+    """
+
+    return httpx.Client(
+        http2=True,
+        limits=httpx.Limits(
+            max_keepalive_connections=THREADS, max_connections=2 * THREADS
+        ),
+        timeout=httpx.Timeout(80.0, connect=20.0),
+        follow_redirects=True,
+        headers={"User-Agent": "ddb_harvester", "Accept-Encoding": "gzip, deflate"},
+    )
 
 
-def list_sets() -> requests.Response:
+def list_sets(client: httpx.Client) -> httpx.Response:
     """
     List all sets available in the DDB OAI-PMH endpoint.
 
+    Args:
+        client (httpx.Client): The HTTP client.
+
     Returns:
-        requests.Response: The response object from the OAI-PMH endpoint.
+        httpx.Response: The response object from the OAI-PMH endpoint.
 
     """
 
     params = {"verb": "ListSets"}
-    result = requests.get(OAI_URL, params=params, timeout=None)
+    result = client.get(OAI_URL, params=params, timeout=None)
 
     if result.status_code != 200:
-        print(f"Error {result.status_code}: {result.text}")
+        logger.error("Error %s: %s", result.status_code, result.text)
         return None
 
     return result
 
 
-def parse_sets(xml_data: str) -> list[str]:
+def parse_sets(xml_data: bytes) -> list[str]:
     """
     Parse the XML data to extract the set specifications (set-ids).
 
     Args:
-        xml_data (str): The XML response from the ListSets call on the OAI-PMH endpoint.
+        xml_data (bytes): The XML response from the ListSets call on the OAI-PMH endpoint.
 
     Returns:
         list: A list of set ids.
@@ -46,152 +106,406 @@ def parse_sets(xml_data: str) -> list[str]:
     """
 
     sets = []
-    root = ET.fromstring(xml_data)
-    for set_element in root.findall(".//{http://www.openarchives.org/OAI/2.0/}set"):
-        set_spec = set_element.find(
-            "{http://www.openarchives.org/OAI/2.0/}setSpec"
-        ).text
+    root = etree.fromstring(xml_data)
+    for set_spec in SET_SPEC(root):
         if ":" not in set_spec:
             sets.append(set_spec)
     return sets
 
 
-def make_request(
-    params: dict, session: requests.Session, retries=0
-) -> requests.Response:
+def make_request(params: dict, client: httpx.Client) -> httpx.Response:
     """
     Make a request to the OAI-PMH endpoint.
 
+    Transport errors (failed connections, timeouts, broken streams), bodies that fail to
+    decompress and 5xx/429 responses are retried up to MAX_RETRIES times with a jittered
+    exponential backoff capped at MAX_BACKOFF seconds. Other HTTP errors are raised
+    immediately.
+
     Args:
-        params (dict): The parameters to send with the request.
-        session (requests.Session): The requests session object to use for the request.
-        retries (int): The number of retries attempted so far.
+        params (dict): The parameters to be passed to the OAI-PMH endpoint.
+        client (httpx.Client): The HTTP client.
+
+    Returns:
+        httpx.Response: The response object from the OAI-PMH endpoint.
+
+    """
+
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt:
+            time.sleep(min(MAX_BACKOFF, 2 ** (attempt - 1)) + random.random())
+
+        try:
+            response = client.get(OAI_URL, params=params)
+            response.raise_for_status()
+            return response
+
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code < 500 and e.response.status_code != 429:
+                raise
+
+            error = e
+
+        except (httpx.TransportError, httpx.DecodingError) as e:
+            error = e
+
+    raise error
+
+
+def load_state() -> dict:
+    """
+    Read the harvest state log and get the last checkpoint of every set. A torn line left by
+    a crash at the end of the log is cut off, so new checkpoints start on a fresh line.
 
     Returns:
-        requests.Response: The response object from the OAI-PMH endpoint.
+        dict: The last checkpoint (set, resumption token and record count) per set id.
+            A token of None marks a completed set.
 
     """
 
+    state_path = os.path.join(SAVE_DIR, STATE_FILE)
+
     try:
-        response = session.get(OAI_URL, params=params, timeout=(20, 80))
-        response.raise_for_status()
-        return response
+        with open(state_path, "rb") as f:
+            data = f.read()
+
+    except FileNotFoundError:
+        return {}
+
+    if not data.endswith(b"\n"):
+        os.truncate(state_path, data.rfind(b"\n") + 1)
+
+    lines = data.split(b"\n")[:-1]
+
+    state = {}
+
+    for line in lines:
+        try:
+            checkpoint = orjson.loads(line)
+
+        except orjson.JSONDecodeError:
+            continue
+
+        state[checkpoint["set"]] = checkpoint
+
+    return state
+
 
-    except requests.exceptions.RequestException as e:
-        if retries < MAX_RETRIES:
-            wait_time = 2**retries
-            time.sleep(wait_time)
-            return make_request(params, session, retries + 1)
+def save_state(set_spec: str, resumption_token: str | None, harvested_records: int):
+    """
+    Append a checkpoint for a set to the harvest state log. The log is synced to disk every
+    CHECKPOINT_INTERVAL checkpoints and whenever a set is completed.
+
+    Args:
+        set_spec (str): The set specification (set-id).
+        resumption_token (str | None): The token of the next page, None once the set is completed.
+        harvested_records (int): The number of records harvested for the set so far.
+
+    """
+
+    global state_writes
+
+    line = orjson.dumps(
+        {"set": set_spec, "token": resumption_token, "count": harvested_records}
+    )
+
+    with state_lock:
+        fd = os.open(
+            os.path.join(SAVE_DIR, STATE_FILE),
+            os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+            0o644,
+        )
 
-        raise e
+        try:
+            write_all(fd, line + b"\n")
+            state_writes += 1
 
+            if resumption_token is None or state_writes % CHECKPOINT_INTERVAL == 0:
+                os.fsync(fd)
 
-def list_records(set_spec: str, session: requests.Session) -> list[str]:
+        finally:
+            os.close(fd)
+
+
+def list_records(
+    set_spec: str, client: httpx.Client, checkpoint: dict | None = None
+) -> Generator[bytes, None, None]:
     """
-    Get all records for a given set.
+    Get all records for a given set. Records are yielded page by page as they are parsed.
+
+    A checkpoint is saved to the harvest state log after every finished page, so an
+    interrupted harvest continues from the last checkpointed page. If the server rejects
+    the checkpointed resumption token, the set is harvested again from the start. Other
+    OAI errors are logged and leave the last checkpoint in place; the set is only marked
+    as completed once a ListRecords page ends without a resumption token.
 
     Args:
         set_spec (str): The set specification to list records for.
-        session (requests.Session): The requests session object.
+        client (httpx.Client): The HTTP client.
+        checkpoint (dict | None): The checkpoint of an interrupted harvest of the set.
 
-    Returns:
-        list: A list of record XML strings.
+    Yields:
+        bytes: A record as UTF-8 encoded XML.
 
     """
 
-    records = []
+    harvested_records = checkpoint["count"] if checkpoint else 0
+    resumption_token = checkpoint["token"] if checkpoint else None
     expected_records_in_set = 0
-    resumption_token = None
 
-    params = {
-        "verb": "ListRecords",
-        "metadataPrefix": METADATA_PREFIX,
-        "set": set_spec,
-    }
+    if resumption_token:
+        logger.info("Resuming set %s after %d records.", set_spec, harvested_records)
+
+    restarted = False
 
     while True:
         if resumption_token:
+            params = {"verb": "ListRecords", "resumptionToken": resumption_token}
+
+        else:
             params = {
                 "verb": "ListRecords",
-                "resumptionToken": resumption_token,
+                "metadataPrefix": METADATA_PREFIX,
+                "set": set_spec,
             }
 
-        response = make_request(params, session)
+        response = make_request(params, client)
 
         if response.status_code == 200:
-            records.extend(parse_records_list(response.text))
+            root, page_records = yield from parse_records_list(response.content)
+            errors = OAI_ERROR(root)
+
+            if errors:
+                error_code = errors[0].get("code")
+
+                if error_code == "badResumptionToken" and not restarted:
+                    logger.warning(
+                        "Resumption token for set %s was rejected, restarting the set.",
+                        set_spec,
+                    )
+                    restarted = True
+                    harvested_records = 0
+                    expected_records_in_set = 0
+                    resumption_token = None
+                    continue
+
+                if error_code == "noRecordsMatch" and not resumption_token:
+                    break
+
+                logger.error(
+                    "OAI error %s for set %s: %s", error_code, set_spec, errors[0].text
+                )
+                return
+
+            if not LIST_RECORDS(root):
+                logger.error("Unexpected response for set %s without records.", set_spec)
+                return
+
+            harvested_records += page_records
+            resumption_tokens = RESUMPTION_TOKEN(root)
+            resumption_token_element = resumption_tokens[0] if resumption_tokens else None
 
             if expected_records_in_set == 0:
-                try:
+                if resumption_token_element is not None:
                     expected_records_in_set = int(
-                        ET.fromstring(response.text)
-                        .find(
-                            ".//{http://www.openarchives.org/OAI/2.0/}resumptionToken"
-                        )
-                        .attrib["completeListSize"]
+                        resumption_token_element.get("completeListSize")
                     )
 
-                except AttributeError:
-                    print("No resumption token found.")
-                    expected_records_in_set = len(records)
-
-            print(f"Records harvested: {len(records)}/{expected_records_in_set}")
+                else:
+                    logger.info("No resumption token found for set %s.", set_spec)
+                    expected_records_in_set = harvested_records
 
-            root = ET.fromstring(response.text)
-            resumption_token = root.findtext(
-                ".//{http://www.openarchives.org/OAI/2.0/}resumptionToken"
+            logger.info(
+                "Records harvested for set %s: %d/%d",
+                set_spec,
+                harvested_records,
+                expected_records_in_set,
             )
 
-            if not resumption_token:
+            if resumption_token_element is None or not resumption_token_element.text:
+                save_state(set_spec, None, harvested_records)
                 break
+
+            resumption_token = resumption_token_element.text
+            save_state(set_spec, resumption_token, harvested_records)
+
         else:
             break
 
-    return records
 
+def parse_records_list(xml_data: bytes) -> Generator[bytes, None, tuple]:
+    """
+    Parse the XML data to extract the records as UTF-8 encoded XML.
+
+    The response is streamed with iterparse and every record is cleared once it has been
+    serialized, so only a single record subtree is held in memory at a time.
+
+    Args:
+        xml_data (bytes): The XML response from the ListRecords call on the OAI-PMH endpoint.
+
+    Yields:
+        bytes: A record as UTF-8 encoded XML.
 
-def parse_records_list(xml_data: str) -> list[str]:
+    Returns:
+        tuple: The root element of the response and the number of records on the page.
+
+    """
+
+    records = 0
+    context = etree.iterparse(
+        io.BytesIO(xml_data), tag=f"{NS}record", huge_tree=True
+    )
+
+    for _, record in context:
+        yield etree.tostring(record, encoding="utf-8", with_tail=False)
+        records += 1
+
+        record.clear()
+        while record.getprevious() is not None:
+            del record.getparent()[0]
+
+    return context.root, records
+
+
+def open_batch(dataset_id: str, batch_number: int) -> int:
     """
-    Parse the XML data to extract the records as XML-strings.
+    Open a new batch file and write the opening tag of its <records> root element.
 
     Args:
-        xml_data (str): The XML response from the ListRecords call on the OAI-PMH endpoint.
+        dataset_id (str): The dataset identifier.
+        batch_number (int): The number of the batch within the dataset.
 
     Returns:
-        list: A list of record XML strings.
+        int: The file descriptor of the batch file.
+
+    """
+
+    output_dir = os.path.join(SAVE_DIR, dataset_id)
+
+    if dataset_id not in created_dirs:
+        os.makedirs(output_dir, exist_ok=True)
+        created_dirs.add(dataset_id)
+
+    batch_file_path = os.path.join(output_dir, f"batch-{batch_number}.xml")
+    logger.debug("Opening batch file: %s", batch_file_path)
+
+    fd = os.open(batch_file_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    write_all(fd, BATCH_HEADER)
 
+    return fd
+
+
+def close_batch(fd: int):
+    """
+    Write the closing tag of the <records> root element and close the batch file.
+
+    Args:
+        fd (int): The file descriptor of the batch file.
+
+    """
+
+    try:
+        write_all(fd, BATCH_FOOTER)
+
+    finally:
+        os.close(fd)
+
+
+def write_all(fd: int, data: bytes):
     """
+    Write data to a file descriptor, repeating os.write until nothing is left after partial writes.
 
-    records = []
+    Args:
+        fd (int): The file descriptor to write to.
+        data (bytes): The data to write.
 
-    root = etree.fromstring(xml_data.encode(encoding="utf-8"))
+    """
 
-    for record in root.findall(".//{http://www.openarchives.org/OAI/2.0/}record"):
-        record_xml = etree.tostring(record, encoding="unicode", pretty_print=True)
-        records.append(record_xml)
+    view = memoryview(data)
 
-    return records
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
 
 
-def save_record(record_xml: str, dataset_id: str):
+def save_record(record_xml: bytes, fd: int):
     """
-    Save the record to a file.
+    Append the record to an open batch file.
 
     Args:
-        record_xml (str): The record XML as a string.
+        record_xml (bytes): The record as UTF-8 encoded XML.
+        fd (int): The file descriptor of the batch file.
+
+    """
+
+    write_all(fd, record_xml + b"\n")
+
+
+def save_records(records: Iterable[bytes], dataset_id: str) -> int:
+    """
+    Save the records of a dataset to batch files of up to BATCH_SIZE records each. Every
+    batch file is a well-formed XML document with the records inside a <records> root. Records
+    are appended as they arrive, so records of a page that was interrupted before its
+    checkpoint are appended again when the harvest resumes.
+
+    Args:
+        records (Iterable[bytes]): The records as UTF-8 encoded XML.
         dataset_id (str): The dataset identifier.
 
+    Returns:
+        int: The number of saved records.
+
     """
 
     output_dir = os.path.join(SAVE_DIR, dataset_id)
-    os.makedirs(output_dir, exist_ok=True)
+    batch_number = 0
 
-    record = etree.fromstring(record_xml.encode(encoding="utf-8"))
-    identifier = record.find(".//{http://www.openarchives.org/OAI/2.0/}identifier").text
+    if os.path.isdir(output_dir):
+        batch_number = sum(
+            1 for name in os.listdir(output_dir) if name.startswith("batch-")
+        )
 
-    record_file_path = os.path.join(output_dir, f"{identifier}.xml")
-    with open(record_file_path, "w", encoding="utf-8") as file:
-        file.write(record_xml)
+    saved_records = 0
+    fd = None
+
+    try:
+        for record_xml in records:
+            if saved_records % BATCH_SIZE == 0:
+                if fd is not None:
+                    close_batch(fd)
+                    batch_number += 1
+
+                fd = open_batch(dataset_id, batch_number)
+
+            save_record(record_xml, fd)
+            saved_records += 1
+
+    finally:
+        if fd is not None:
+            close_batch(fd)
+
+    return saved_records
+
+
+def harvest_set(set_spec: str, client: httpx.Client, checkpoint: dict | None = None):
+    """
+    Harvest all records of a set into batch files.
+
+    Args:
+        set_spec (str): The set specification to harvest.
+        client (httpx.Client): The HTTP client.
+        checkpoint (dict | None): The checkpoint of an interrupted harvest of the set.
+
+    """
+
+    logger.info("Processing set: %s", set_spec)
+    harvested_records = save_records(list_records(set_spec, client, checkpoint), set_spec)
+
+    if harvested_records:
+        logger.info("Collected %d records for set %s", harvested_records, set_spec)
+
+    else:
+        logger.info("No records found for set %s", set_spec)
 
 
 def harvest_ddb_data():
@@ -200,28 +514,54 @@ def harvest_ddb_data():
 
     """
 
-    response = list_sets()
+    os.makedirs(SAVE_DIR or os.curdir, exist_ok=True)
+    state = load_state()
 
-    if response:
-        sets = parse_sets(response.text)
+    with create_client() as client:
+        response = list_sets(client)
 
-        print(f"Found {len(sets)} unique sets.")
+        if response:
+            sets = parse_sets(response.content)
 
-        session = requests.Session()
+            logger.info("Found %d unique sets.", len(sets))
 
-        for set_spec in sets:
-            print(f"Processing set: {set_spec}")
-            records = list_records(set_spec, session)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=THREADS) as executor:
+                inflight = set()
 
-            if records:
-                for record in records:
-                    save_record(record, set_spec)
+                for set_spec in sets:
+                    checkpoint = state.get(set_spec)
 
-                print(f"Collected {len(records)} records for set {set_spec}")
+                    if checkpoint and checkpoint["token"] is None:
+                        logger.info("Skipping completed set: %s", set_spec)
+                        continue
 
-            else:
-                print(f"No records found for set {set_spec}")
+                    if len(inflight) >= 2 * THREADS:
+                        done, inflight = concurrent.futures.wait(
+                            inflight, return_when=concurrent.futures.FIRST_COMPLETED
+                        )
+
+                        for future in done:
+                            future.result()
+
+                    inflight.add(
+                        executor.submit(harvest_set, set_spec, client, checkpoint)
+                    )
+
+                for future in concurrent.futures.as_completed(inflight):
+                    future.result()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=LOG_LEVEL,
+        handlers=[
+            logging.handlers.MemoryHandler(
+                capacity=1024,
+                flushLevel=logging.INFO,
+                target=logging.StreamHandler(),
+            )
+        ],
+    )
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
     harvest_ddb_data()